@@ -0,0 +1,159 @@
+# calibration.py
+"""
+Per-wavelength background and IRF references for the TH260.
+
+References are measured through a TH260Client and stored under a directory
+keyed by the helper's init settings (binning, offsets, sync divider), since a
+different init changes bin width and timing. At scan time Calibration.prepare()
+turns them into per-wavelength background histograms and IRF alignment
+shifts once, so correcting a voxel is a single vectorized subtract-and-gather.
+
+Corrected histograms are saved alongside the raw ones as 'counts_corr'.
+"""
+import os
+import time
+import numpy as np
+
+CALIBRATION_DIR = os.path.join(os.path.expanduser("~"), "SpectralFLIM", "calibration")
+
+
+def settings_key(settings):
+    """Directory name for a TH260 init configuration."""
+    return "bin{binning}_off{offset_ps}_sdiv{sync_div}_soff{sync_offset_ps}".format(**settings)
+
+
+class CalibrationCache:
+    """Stores background.npz / irf.npz per TH260 init configuration."""
+    def __init__(self, root=CALIBRATION_DIR):
+        self.root = root
+
+    def _path(self, settings, name):
+        return os.path.join(self.root, settings_key(settings), f"{name}.npz")
+
+    def save(self, settings, name, **arrays):
+        path = self._path(settings, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        np.savez_compressed(path, acquired=time.time(), **arrays)
+        return path
+
+    def load(self, settings, name):
+        """dict of arrays, or None if this reference has not been measured."""
+        path = self._path(settings, name)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as z:
+            return {k: z[k] for k in z.files}
+
+
+def _measure(th, wls, goto, tacq_ms, repeats, settle_s):
+    """Mean histogram per wavelength, (wl, ch, bins) float64 in counts per ms."""
+    out = []
+    for nm in wls:
+        goto(nm)
+        time.sleep(settle_s)
+        acc = None
+        for _ in range(repeats):
+            c = th.acquire(tacq_ms=tacq_ms).astype(np.float64)
+            acc = c if acc is None else acc + c
+        out.append(acc / (repeats * tacq_ms))
+    return np.stack(out)
+
+
+def acquire_background(th, cache, wls, goto, tacq_ms=1000, repeats=3, settle_s=0.8):
+    """
+    Measure dark/afterpulsing background at each wavelength. The caller is
+    responsible for blocking the excitation (e.g. closing the shutter).
+    """
+    rates = _measure(th, wls, goto, tacq_ms, repeats, settle_s)
+    return cache.save(th.settings, "background",
+                      wavelengths_nm=np.asarray(wls, dtype=np.float64), rates=rates)
+
+
+def acquire_irf(th, cache, wls, goto, tacq_ms=1000, repeats=1, settle_s=0.8):
+    """
+    Measure the instrument response (scatterer in place) at each wavelength.
+    Stored background-subtracted and normalized to unit area per channel.
+    """
+    rates = _measure(th, wls, goto, tacq_ms, repeats, settle_s)
+    bg = cache.load(th.settings, "background")
+    if bg is not None and bg["rates"].shape[1:] == rates.shape[1:]:
+        rates = rates - _interp_wl(bg["wavelengths_nm"], bg["rates"], wls)
+    rates = np.clip(rates, 0, None)
+    irf = rates / np.maximum(rates.sum(axis=-1, keepdims=True), 1e-300)
+    return cache.save(th.settings, "irf",
+                      wavelengths_nm=np.asarray(wls, dtype=np.float64), irf=irf,
+                      peak_bin=irf.argmax(axis=-1))
+
+
+def _interp_wl(ref_wls, ref, wls):
+    """Linear interpolation of ref (n_ref, ...) along wavelength, clamped at the ends."""
+    ref_wls = np.asarray(ref_wls, dtype=np.float64)
+    wls = np.asarray(wls, dtype=np.float64)
+    # References are stored in the order they were typed; searchsorted needs them sorted
+    order = np.argsort(ref_wls)
+    ref_wls, ref = ref_wls[order], ref[order]
+    if len(ref_wls) == 1:
+        return np.repeat(ref[:1], len(wls), axis=0)
+    i1 = np.clip(np.searchsorted(ref_wls, wls), 1, len(ref_wls) - 1)
+    i0 = i1 - 1
+    w = np.clip((wls - ref_wls[i0]) / (ref_wls[i1] - ref_wls[i0]), 0.0, 1.0)
+    w = w.reshape((-1,) + (1,) * (ref.ndim - 1))
+    return (1.0 - w) * ref[i0] + w * ref[i1]
+
+
+class Calibration:
+    """
+    Background subtraction and IRF alignment for one scan. Build with
+    Calibration(cache, th.settings) and call prepare() once before acquiring.
+    """
+    def __init__(self, cache, settings):
+        self.background = cache.load(settings, "background")
+        self.irf = cache.load(settings, "irf")
+        self._bg = {}
+        self._src = {}
+
+    @property
+    def available(self):
+        return self.background is not None or self.irf is not None
+
+    def prepare(self, wls, tacq_ms, hist_shape):
+        """Precompute background (ch, bins) and gather indices per scan wavelength."""
+        ch, nbins = hist_shape
+        wls = [float(nm) for nm in wls]
+        # A reference taken with a different histogram layout cannot be applied;
+        # refuse rather than writing uncorrected data labelled as corrected.
+        refs = []
+        if self.background is not None:
+            refs.append(("background", self.background["rates"]))
+        if self.irf is not None:
+            refs.append(("IRF", self.irf["irf"]))
+        for name, ref in refs:
+            if ref.shape[1:] != tuple(hist_shape):
+                raise ValueError(f"Stored {name} reference has shape {ref.shape[1:]}, "
+                                 f"histograms are {tuple(hist_shape)}; re-acquire it.")
+        if self.background is not None:
+            bg = _interp_wl(self.background["wavelengths_nm"], self.background["rates"], wls) * tacq_ms
+            self._bg = {nm: bg[k].astype(np.float32) for k, nm in enumerate(wls)}
+        if self.irf is not None:
+            ref_wls = self.irf["wavelengths_nm"]
+            peaks = self.irf["peak_bin"]
+            # Align every wavelength/channel to the median IRF peak
+            target = int(np.median(peaks))
+            bins = np.arange(nbins)
+            for nm in wls:
+                shift = target - peaks[int(np.argmin(np.abs(ref_wls - nm)))]
+                self._src[nm] = bins[None, :] - shift[:, None]
+        return self
+
+    def correct(self, counts, nm):
+        """Corrected float32 histogram (ch, bins) for one voxel at wavelength nm."""
+        out = counts.astype(np.float32)
+        bg = self._bg.get(float(nm))
+        if bg is not None:
+            out = np.clip(out - bg, 0, None)
+        src = self._src.get(float(nm))
+        if src is not None:
+            valid = (src >= 0) & (src < out.shape[1])
+            rows = np.arange(out.shape[0])[:, None]
+            out = np.where(valid, out[rows, np.clip(src, 0, out.shape[1] - 1)], 0).astype(np.float32)
+        return out
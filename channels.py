@@ -0,0 +1,110 @@
+# channels.py
+"""
+Per-channel processing of TH260 histograms during a FLIM scan.
+
+TH260Client.acquire returns (ch, LEN). channel_stats() reduces all channels
+at once (photons, mean arrival time) and derives cross-channel quantities:
+the ratio of every channel to channel 0 and, for two channels, the steady-state
+anisotropy r = (I_par - G I_perp) / (I_par + 2 G I_perp) with channel 0 as the
+parallel and channel 1 as the perpendicular detector.
+
+ChannelPipeline moves that reduction and the NPZ compression off the
+acquisition thread into a small worker pool, so the next voxel is being
+acquired while the previous one is reduced and written. Per-voxel results are
+collected into maps saved as channels.npz at the end of the scan.
+"""
+import os
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+
+def _derived(photons, g_factor):
+    """Ratio to channel 0 (..., ch) and ch0/ch1 anisotropy (...) from photon sums."""
+    with np.errstate(invalid="ignore", divide="ignore"):
+        ratio = photons / photons[..., :1]
+        if photons.shape[-1] >= 2:
+            par, perp = photons[..., 0], photons[..., 1]
+            anisotropy = (par - g_factor * perp) / (par + 2.0 * g_factor * perp)
+        else:
+            anisotropy = np.full(photons.shape[:-1], np.nan)
+    return ratio, anisotropy
+
+
+def channel_stats(counts, res_ps, g_factor=1.0):
+    """
+    counts: (..., ch, bins). Returns dict of arrays with shape (..., ch) for
+    photons / mean_ps / ratio, and (...) for anisotropy (NaN if fewer than 2 channels).
+    """
+    c = np.asarray(counts, dtype=np.float64)
+    t = np.arange(c.shape[-1]) * res_ps
+    photons = c.sum(axis=-1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean_ps = (c @ t) / photons
+    ratio, anisotropy = _derived(photons, g_factor)
+    return {"photons": photons, "mean_ps": mean_ps, "ratio": ratio, "anisotropy": anisotropy}
+
+
+class ChannelPipeline:
+    """
+    Reduce and save voxels in worker threads (numpy reductions and zlib release
+    the GIL). At most `backlog` voxels are queued so memory stays bounded if
+    the disk falls behind.
+    """
+    def __init__(self, shape, channels, res_ps, g_factor=1.0, workers=2, backlog=8):
+        self.res_ps = res_ps
+        self.g_factor = g_factor
+        self.photons = np.zeros(tuple(shape) + (channels,), dtype=np.float64)
+        self.mean_ps = np.full(tuple(shape) + (channels,), np.nan, dtype=np.float32)
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._slots = threading.BoundedSemaphore(backlog)
+        self._errors = []
+
+    def submit(self, index, fname, counts, **arrays):
+        """Queue one voxel: index is its (iy, ix, k) position in the maps."""
+        if self._errors:
+            raise self._errors[0]
+        self._slots.acquire()
+        try:
+            self._pool.submit(self._process, index, fname, counts, arrays)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def _process(self, index, fname, counts, arrays):
+        try:
+            s = channel_stats(counts, self.res_ps, self.g_factor)
+            self.photons[index] = s["photons"]
+            self.mean_ps[index] = s["mean_ps"]
+            np.savez_compressed(
+                fname,
+                counts=counts,
+                channel_photons=s["photons"],
+                channel_mean_ps=s["mean_ps"],
+                anisotropy=s["anisotropy"],
+                **arrays,
+            )
+        except Exception as e:
+            self._errors.append(e)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        """Wait for queued voxels; return the first worker error (or None)."""
+        self._pool.shutdown(wait=True)
+        return self._errors[0] if self._errors else None
+
+    def save(self, outdir, wavelengths_nm):
+        """Write per-channel maps and derived ratio/anisotropy maps to channels.npz."""
+        ratio, anisotropy = _derived(self.photons, self.g_factor)
+        path = os.path.join(outdir, "channels.npz")
+        np.savez_compressed(
+            path,
+            photons=self.photons,
+            mean_ps=self.mean_ps,
+            ratio=ratio.astype(np.float32),
+            anisotropy=anisotropy.astype(np.float32),
+            g_factor=self.g_factor,
+            wavelengths_nm=np.asarray(wavelengths_nm),
+        )
+        return path
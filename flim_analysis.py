@@ -0,0 +1,225 @@
+# flim_analysis.py
+"""
+Spectral / lifetime unmixing of FLIM scan folders.
+
+Every pixel is modelled as a non-negative sum of reference components:
+    spectra only  -> data summed over time,        basis (wl, k)
+    decays only   -> data summed over wavelength,  basis (bins, k)
+    both          -> full spectral-lifetime voxel, basis (wl*bins, k),
+                     component j = outer(spectrum_j, decay_j)
+All pixels of a row chunk are solved at once by a batched projected-gradient
+NNLS, and chunks run in a process pool. Chunks are sized from a per-worker
+byte budget, so memory stays bounded by workers * chunk_mb.
+
+When no reference decays are given, global_lifetimes() fits lifetimes linked
+across all wavelengths (decay-associated spectra) and those decays are used.
+
+Usage:
+    python flim_analysis.py <scan folder> [refs.npz] [--corrected] [n_components]
+refs.npz may hold 'spectra' (wl, k), 'decays' (bins, k), 'taus_ps' (k,), 'irf' (bins,).
+"""
+import os
+import sys
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+from flim_cube import ScanIndex
+
+
+def nnls_gram(G, C, iters=500, tol=1e-6):
+    """
+    Solve min ||A x - b||, x >= 0 for many b given only G = A^T A (k, k)
+    and C = A^T B (k, N). Returns X: (k, N).
+    """
+    lip = np.linalg.eigvalsh(G)[-1]
+    if lip <= 0:
+        return np.zeros(C.shape)
+    # Unconstrained solution clipped to the feasible set is a good start
+    X = np.clip(np.linalg.lstsq(G, C, rcond=None)[0], 0, None)
+    Y, t = X.copy(), 1.0
+    for _ in range(iters):
+        Xn = np.clip(Y - (G @ Y - C) / lip, 0, None)
+        tn = (1.0 + np.sqrt(1.0 + 4.0 * t * t)) / 2.0
+        Y = Xn + ((t - 1.0) / tn) * (Xn - X)
+        step = np.abs(Xn - X).max()
+        X, t = Xn, tn
+        if step <= tol * max(X.max(), 1e-12):
+            break
+    return X
+
+
+def nnls_batch(A, B, iters=500, tol=1e-6):
+    """
+    Solve min ||A x - b||, x >= 0 for every column b of B at once.
+    A: (M, k), B: (M, N). Returns X: (k, N).
+    """
+    A = np.asarray(A, dtype=np.float64)
+    B = np.asarray(B, dtype=np.float64)
+    return nnls_gram(A.T @ A, A.T @ B, iters, tol)
+
+
+def decay_basis(taus_ps, nbins, res_ps, irf=None):
+    """
+    Unit-area exponential decays (bins, k), optionally convolved with an IRF.
+    """
+    t = np.arange(nbins) * res_ps
+    taus = np.atleast_1d(np.asarray(taus_ps, dtype=np.float64))
+    D = np.exp(-t[:, None] / taus[None, :])
+    if irf is not None:
+        irf = np.asarray(irf, dtype=np.float64)
+        n = 2 * nbins
+        D = np.fft.irfft(np.fft.rfft(D, n, axis=0) * np.fft.rfft(irf, n)[:, None], n, axis=0)[:nbins]
+        D = np.clip(D, 0, None)
+    return D / np.maximum(D.sum(axis=0, keepdims=True), 1e-300)
+
+
+def _reduce(voxels, mode, channel):
+    """(npix, wl, ch, bins) -> (npix, M) in the layout the basis expects."""
+    v = voxels.sum(axis=2) if channel is None else voxels[:, :, channel]
+    if mode == "spectra":
+        return v.sum(axis=2)
+    if mode == "decays":
+        return v.sum(axis=1)
+    return v.reshape(v.shape[0], -1)
+
+
+def _build_basis(spectra, decays):
+    if spectra is not None and decays is not None:
+        S = np.asarray(spectra, dtype=np.float64)
+        D = np.asarray(decays, dtype=np.float64)
+        if S.shape[1] != D.shape[1]:
+            raise ValueError("spectra and decays must have the same number of components")
+        return "both", np.einsum("lk,tk->ltk", S, D).reshape(-1, S.shape[1])
+    if spectra is not None:
+        return "spectra", np.asarray(spectra, dtype=np.float64)
+    if decays is not None:
+        return "decays", np.asarray(decays, dtype=np.float64)
+    raise ValueError("Need reference spectra and/or decays")
+
+
+def _unmix_chunk(idx, y0, y1, mode, basis, channel, key):
+    cube = idx.load_rows(y0, y1, key=key)
+    rows, width = cube.shape[:2]
+    data = _reduce(cube.reshape((rows * width,) + cube.shape[2:]), mode, channel)
+    del cube
+    # Work from the Gram form so nothing of size (M, npix) beyond data is built
+    G = basis.T @ basis
+    C = (data @ basis.astype(np.float32)).T.astype(np.float64)
+    X = nnls_gram(G, C)
+    # ||b - A x||^2 = ||b||^2 - 2 x.c + x.G x
+    bb = np.einsum("nm,nm->n", data, data, dtype=np.float64)
+    r2 = bb - 2.0 * (X * C).sum(axis=0) + (X * (G @ X)).sum(axis=0)
+    resid = np.sqrt(np.clip(r2, 0, None))
+    return y0, X.T.reshape(rows, width, -1), resid.reshape(rows, width)
+
+
+def _rows_per_chunk(idx, mode, chunk_mb):
+    """Rows per worker chunk so the float32 cube plus reduced data fit in chunk_mb."""
+    L, ch, T = len(idx.wavelengths), idx.channels, idx.hist_len
+    reduced = {"spectra": L, "decays": T}.get(mode, L * T)
+    per_row = idx.width * 4 * (L * ch * T + reduced)
+    return max(1, int(chunk_mb * 2**20 // per_row))
+
+
+def global_lifetimes(outdir, taus0_ps, irf=None, channel=None, rounds=8, chunk_mb=256,
+                     key="counts"):
+    """
+    Fit lifetimes shared by all wavelengths to the spatially summed decays.
+    Returns (taus_ps, das) where das (wl, k) are the decay-associated spectra.
+    key="counts_corr" uses background/IRF corrected histograms when present.
+    """
+    idx = ScanIndex(outdir)
+    decays = np.zeros((len(idx.wavelengths), idx.hist_len))
+    # The channel sum keeps (wl, bins) per pixel, so budget like the "both" layout
+    for y0, y1 in idx.row_chunks(_rows_per_chunk(idx, "both", chunk_mb)):
+        cube = idx.load_rows(y0, y1, key=key)
+        v = cube.sum(axis=3) if channel is None else cube[:, :, :, channel]
+        decays += v.sum(axis=(0, 1))
+
+    def cost(log_taus):
+        D = decay_basis(np.exp(log_taus), idx.hist_len, idx.res_ps, irf)
+        X = nnls_batch(D, decays.T, iters=200)
+        return ((D @ X - decays.T) ** 2).sum()
+
+    # Coordinate search in log(tau); each component is refined on a shrinking grid
+    log_taus = np.log(np.asarray(taus0_ps, dtype=np.float64))
+    span = 1.0
+    for _ in range(rounds):
+        for j in range(len(log_taus)):
+            trial = log_taus[j] + np.linspace(-span, span, 9)
+            costs = []
+            for v in trial:
+                lt = log_taus.copy(); lt[j] = v
+                costs.append(cost(lt))
+            log_taus[j] = trial[int(np.argmin(costs))]
+        span /= 2.0
+    order = np.argsort(log_taus)
+    taus = np.exp(log_taus[order])
+    D = decay_basis(taus, idx.hist_len, idx.res_ps, irf)
+    return taus, nnls_batch(D, decays.T).T
+
+
+def unmix(outdir, spectra=None, decays=None, channel=None,
+          workers=None, chunk_mb=256, save=True, key="counts"):
+    """
+    Abundance maps (height, width, k) and residual norm (height, width) for a scan.
+    Each worker holds roughly chunk_mb of data at a time.
+    Written to <outdir>/unmix_abundance.npz when save is True.
+    """
+    idx = ScanIndex(outdir)
+    if spectra is not None and np.shape(spectra)[0] != len(idx.wavelengths):
+        raise ValueError(f"Reference spectra have {np.shape(spectra)[0]} rows, "
+                         f"scan has {len(idx.wavelengths)} wavelengths")
+    if decays is not None and np.shape(decays)[0] != idx.hist_len:
+        raise ValueError(f"Reference decays have {np.shape(decays)[0]} bins, "
+                         f"scan has {idx.hist_len}")
+    mode, basis = _build_basis(spectra, decays)
+
+    abundance = np.zeros((idx.height, idx.width, basis.shape[1]), dtype=np.float32)
+    residual = np.zeros((idx.height, idx.width), dtype=np.float32)
+    chunks = idx.row_chunks(_rows_per_chunk(idx, mode, chunk_mb))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_unmix_chunk, idx.rows(y0, y1), y0, y1, mode, basis, channel, key)
+                   for y0, y1 in chunks]
+        for f in futures:
+            y0, X, r = f.result()
+            abundance[y0:y0 + X.shape[0]] = X
+            residual[y0:y0 + X.shape[0]] = r
+
+    if save:
+        np.savez_compressed(
+            os.path.join(outdir, "unmix_abundance.npz"),
+            abundance=abundance,
+            residual=residual,
+            mode=mode,
+            wavelengths_nm=idx.wavelengths,
+            spectra=np.zeros(0) if spectra is None else np.asarray(spectra),
+            decays=np.zeros(0) if decays is None else np.asarray(decays),
+        )
+    return abundance, residual
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(__doc__, file=sys.stderr)
+        sys.exit(1)
+    scan_dir = sys.argv[1]
+    refs = dict(np.load(sys.argv[2])) if len(sys.argv) > 2 and sys.argv[2].endswith(".npz") else {}
+    n_comp = int(sys.argv[-1]) if sys.argv[-1].isdigit() else 2
+
+    spectra = refs.get("spectra")
+    decays = refs.get("decays")
+    irf = refs.get("irf")
+    key = "counts_corr" if "--corrected" in sys.argv else "counts"
+    if decays is None and (spectra is None or "taus_ps" in refs):
+        idx = ScanIndex(scan_dir)
+        taus0 = refs.get("taus_ps", np.geomspace(500.0, 4000.0, n_comp))
+        taus, das = global_lifetimes(scan_dir, taus0, irf=irf, key=key)
+        print("Global lifetimes (ps):", ", ".join(f"{t:.0f}" for t in taus))
+        decays = decay_basis(taus, idx.hist_len, idx.res_ps, irf)
+        if spectra is None:
+            spectra = das / np.maximum(das.sum(axis=0, keepdims=True), 1e-300)
+
+    abundance, residual = unmix(scan_dir, spectra=spectra, decays=decays, key=key)
+    print(f"Abundance maps {abundance.shape} written to "
+          f"{os.path.join(scan_dir, 'unmix_abundance.npz')}")
@@ -0,0 +1,78 @@
+# flim_cube.py
+"""
+Reading FLIM scan folders written by FlimFrame._scan_thread.
+
+A scan is a folder of y<iy>_x<ix>_nm<nm>.npz files, each holding the TH260
+histogram (ch, LEN) for one pixel and wavelength. These helpers index the
+folder once and load it a few rows at a time so the full cube never has to
+sit in memory.
+"""
+import os
+import re
+import numpy as np
+
+_VOXEL_RE = re.compile(r"^y(\d+)_x(\d+)_nm(-?\d+(?:\.\d+)?)\.npz$")
+
+
+class ScanIndex:
+    """File layout of one scan folder: grid size, wavelengths and voxel paths."""
+    def __init__(self, outdir):
+        self.outdir = outdir
+        self.paths = {}
+        wls = set()
+        height = width = 0
+        for name in os.listdir(outdir):
+            m = _VOXEL_RE.match(name)
+            if not m:
+                continue
+            iy, ix, nm = int(m.group(1)), int(m.group(2)), float(m.group(3))
+            self.paths[(iy, ix, nm)] = os.path.join(outdir, name)
+            wls.add(nm)
+            height = max(height, iy + 1)
+            width = max(width, ix + 1)
+        if not self.paths:
+            raise FileNotFoundError(f"No FLIM voxels in {outdir}")
+        self.height, self.width = height, width
+        self.wavelengths = np.array(sorted(wls))
+
+        with np.load(next(iter(self.paths.values()))) as z:
+            self.res_ps = float(z["res_ps"])
+            self.tacq_ms = int(z["tacq_ms"])
+            self.channels, self.hist_len = z["counts"].shape
+
+    @property
+    def shape(self):
+        """(height, width, wavelengths, channels, bins)"""
+        return (self.height, self.width, len(self.wavelengths), self.channels, self.hist_len)
+
+    def load_rows(self, y0, y1, key="counts", dtype=np.float32, fallback=False):
+        """
+        Load rows [y0, y1) as an array of shape (rows, width, wl, ch, bins).
+        Missing voxels (stopped scans) are left as zeros. A voxel without `key`
+        raises KeyError unless fallback=True, which substitutes raw 'counts'.
+        """
+        out = np.zeros((y1 - y0, self.width, len(self.wavelengths),
+                        self.channels, self.hist_len), dtype=dtype)
+        for iy in range(y0, y1):
+            for ix in range(self.width):
+                for k, nm in enumerate(self.wavelengths):
+                    path = self.paths.get((iy, ix, nm))
+                    if path is None:
+                        continue
+                    with np.load(path) as z:
+                        if key not in z.files and not fallback:
+                            raise KeyError(f"'{key}' not in {path}")
+                        out[iy - y0, ix, k] = z[key] if key in z.files else z["counts"]
+        return out
+
+    def rows(self, y0, y1):
+        """Copy of this index restricted to rows [y0, y1), cheap to send to a worker."""
+        sub = object.__new__(ScanIndex)
+        sub.__dict__.update(self.__dict__)
+        sub.paths = {key: p for key, p in self.paths.items() if y0 <= key[0] < y1}
+        return sub
+
+    def row_chunks(self, rows_per_chunk):
+        """[(y0, y1), ...] covering the scan height."""
+        return [(y, min(y + rows_per_chunk, self.height))
+                for y in range(0, self.height, rows_per_chunk)]
@@ -0,0 +1,192 @@
+# flim_products.py
+"""
+Derived products for browsing a finished FLIM scan without rereading it.
+
+build_products() makes one pass over the scan folder and writes, under
+<outdir>/_products/:
+    photons.npy    (H, W, wl, ch)          photon sum per voxel
+    cumsum.npy     (planes, H, W, wl, ch)  uint32 running sum over time, sampled
+                                           every gate_step bins; counts in a gate
+                                           [t0, t1) are cs[i1] - cs[i0], two
+                                           contiguous planes
+    pyramid_<n>.npy                        photons binned 2**n x 2**n in space
+    manifest.json                          source file count/mtime and shapes
+
+gate_step is chosen so there are at most max_planes + 1 planes, so the cumsum
+costs (max_planes + 1) intensity-sized images instead of a copy of the cube.
+Full-resolution decays are read from the voxel files themselves.
+
+CubeViewer memory-maps these files and serves images from them; products are
+rebuilt automatically when the scan folder has changed.
+
+Usage:
+    python flim_products.py <scan folder>
+"""
+import os
+import sys
+import json
+import numpy as np
+
+from flim_cube import ScanIndex
+
+PRODUCTS_DIR = "_products"
+
+
+def _source_stamp(idx):
+    return {
+        "voxels": len(idx.paths),
+        "mtime": max(os.path.getmtime(p) for p in idx.paths.values()),
+        "shape": list(idx.shape),
+    }
+
+
+def _bin2(a):
+    """Sum 2x2 spatial blocks of (H, W, ...); odd edges are padded with zeros."""
+    h, w = a.shape[:2]
+    pad = [(0, h % 2), (0, w % 2)] + [(0, 0)] * (a.ndim - 2)
+    a = np.pad(a, pad)
+    return a[0::2, 0::2] + a[1::2, 0::2] + a[0::2, 1::2] + a[1::2, 1::2]
+
+
+def _rows_per_chunk(idx, planes, chunk_mb):
+    """Rows per chunk so the uint32 voxels plus uint64 gate planes fit in chunk_mb."""
+    H, W, L, C, T = idx.shape
+    per_row = W * L * C * (4 * T + 2 * 8 * planes)
+    return max(1, int(chunk_mb * 2**20 // per_row))
+
+
+def build_products(outdir, chunk_mb=256, max_planes=256, force=False):
+    """
+    Build (or reuse up-to-date) products for a scan folder. Returns the products dir.
+    Roughly chunk_mb of histograms is held in memory at a time.
+    """
+    idx = ScanIndex(outdir)
+    pdir = os.path.join(outdir, PRODUCTS_DIR)
+    manifest_path = os.path.join(pdir, "manifest.json")
+    stamp = _source_stamp(idx)
+    if not force and os.path.exists(manifest_path):
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            if json.load(f).get("source") == stamp:
+                return pdir
+    os.makedirs(pdir, exist_ok=True)
+
+    H, W, L, C, T = idx.shape
+    gate_step = -(-T // max_planes)
+    # Plane i holds counts in bins [0, i * gate_step); the last plane is the total
+    edges = np.minimum(np.arange(0, T + gate_step, gate_step), T)
+    photons = np.lib.format.open_memmap(os.path.join(pdir, "photons.npy"), mode="w+",
+                                        dtype=np.uint64, shape=(H, W, L, C))
+    cumsum = np.lib.format.open_memmap(os.path.join(pdir, "cumsum.npy"), mode="w+",
+                                       dtype=np.uint32, shape=(len(edges), H, W, L, C))
+    for y0, y1 in idx.row_chunks(_rows_per_chunk(idx, len(edges), chunk_mb)):
+        cube = idx.load_rows(y0, y1, dtype=np.uint32)
+        # Sum each gate_step segment first, then cumsum over the few segments only
+        seg = np.add.reduceat(cube, edges[:-1], axis=-1, dtype=np.uint64)
+        del cube
+        cs = np.cumsum(seg, axis=-1)
+        if cs[..., -1].max(initial=0) >= 2**32:
+            raise OverflowError("Voxel photon count exceeds uint32 cumsum range")
+        cumsum[0, y0:y1] = 0
+        cumsum[1:, y0:y1] = np.moveaxis(cs, -1, 0)
+        photons[y0:y1] = cs[..., -1]
+    cumsum.flush()
+    photons.flush()
+
+    level, img = 0, np.asarray(photons)
+    while min(img.shape[:2]) > 1:
+        level += 1
+        img = _bin2(img)
+        np.save(os.path.join(pdir, f"pyramid_{level}.npy"), img)
+
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        json.dump({
+            "source": stamp,
+            "levels": level,
+            "wavelengths_nm": idx.wavelengths.tolist(),
+            "res_ps": idx.res_ps,
+            "hist_len": T,
+            "gate_step": gate_step,
+        }, f, indent=2)
+    return pdir
+
+
+class CubeViewer:
+    """
+    Read-only access to a scan's products with interactive latency.
+    Images come back as (H, W) arrays; pass nm/channel to select a slice
+    instead of summing over it.
+    """
+    def __init__(self, outdir, build=True):
+        pdir = build_products(outdir) if build else os.path.join(outdir, PRODUCTS_DIR)
+        with open(os.path.join(pdir, "manifest.json"), "r", encoding="utf-8") as f:
+            m = json.load(f)
+        self.wavelengths = np.array(m["wavelengths_nm"])
+        self.res_ps = m["res_ps"]
+        self.levels = m["levels"]
+        self.hist_len = m["hist_len"]
+        self.gate_step = m["gate_step"]
+        self.outdir = outdir
+        self.photons = np.load(os.path.join(pdir, "photons.npy"), mmap_mode="r")
+        self.cumsum = np.load(os.path.join(pdir, "cumsum.npy"), mmap_mode="r")
+        self._pyramid = {0: self.photons}
+        self._pdir = pdir
+
+    def _wl_index(self, nm):
+        k = int(np.argmin(np.abs(self.wavelengths - nm)))
+        if abs(self.wavelengths[k] - nm) > 0.05:
+            raise KeyError(f"{nm} nm not in scan")
+        return k
+
+    def _select(self, a, nm, channel):
+        """a: (H, W, wl, ch, ...) -> sum or slice over wl and ch."""
+        a = a[:, :, self._wl_index(nm)] if nm is not None else a.sum(axis=2)
+        return a[:, :, channel] if channel is not None else a.sum(axis=2)
+
+    def level(self, n):
+        """Photon array binned 2**n in space, (H', W', wl, ch)."""
+        if n not in self._pyramid:
+            self._pyramid[n] = np.load(os.path.join(self._pdir, f"pyramid_{n}.npy"), mmap_mode="r")
+        return self._pyramid[n]
+
+    def intensity(self, level=0, nm=None, channel=None):
+        """Photon image, optionally at one wavelength / channel."""
+        return self._select(self.level(level), nm, channel)
+
+    def wavelength_image(self, nm, level=0, channel=None):
+        return self.intensity(level=level, nm=nm, channel=channel)
+
+    def gate(self, t0_ps, t1_ps, nm=None, channel=None):
+        """
+        Photons arriving in [t0_ps, t1_ps) per pixel, from two cumsum planes.
+        Gate edges snap to the nearest multiple of gate_step bins.
+        """
+        last = self.cumsum.shape[0] - 1
+        step_ps = self.gate_step * self.res_ps
+        i0 = int(np.clip(round(t0_ps / step_ps), 0, last))
+        i1 = int(np.clip(round(t1_ps / step_ps), i0, last))
+        g = self.cumsum[i1].astype(np.int64) - self.cumsum[i0]
+        return self._select(g, nm, channel)
+
+    def decay(self, iy, ix, nm=None, channel=None):
+        """Full-resolution histogram of one pixel, read from its voxel file(s)."""
+        wls = self.wavelengths if nm is None else [self.wavelengths[self._wl_index(nm)]]
+        h = np.zeros(self.hist_len, dtype=np.int64)
+        for w in wls:
+            path = os.path.join(self.outdir, f"y{iy:03d}_x{ix:03d}_nm{w:.1f}.npz")
+            if not os.path.exists(path):
+                continue
+            with np.load(path) as z:
+                c = z["counts"]
+            h += c[channel] if channel is not None else c.sum(axis=0, dtype=np.int64)
+        return h
+
+    def spectrum(self, iy, ix, channel=None):
+        p = self.photons[iy, ix]
+        return p[:, channel] if channel is not None else p.sum(axis=1)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(__doc__, file=sys.stderr)
+        sys.exit(1)
+    print("Products written to", build_products(sys.argv[1], force="--force" in sys.argv))
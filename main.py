@@ -4,6 +4,11 @@ from tkinter import ttk, messagebox, filedialog
 import subprocess
 import json
 import DataMeasurer as dm
+import flim_products
+import scan_catalog
+import calibration
+import channels
+import stage_trajectory
 import numpy as np
 import os
 import base64
@@ -22,6 +27,8 @@ import queue
 # =========================
 TH260_HELPER_PATH = r"helpers\th260_helper.exe"
 STAGE_HELPER_PATH = r"helpers\stage_helper.exe"
+CATALOG_PATH = scan_catalog.CATALOG_PATH
+CALIBRATION_DIR = calibration.CALIBRATION_DIR
 
 # --- Detect if we are in a PyInstaller-built executable ---
 IS_FROZEN = getattr(sys, 'frozen', False) and hasattr(sys, '_MEIPASS')
@@ -78,6 +85,10 @@ def run(command, *args):
 # Tiny line-based IPC helpers (for the two EXEs)
 # =========================
 
+class HelperDied(RuntimeError):
+    """Raised when a helper EXE exits or its stdout closes."""
+
+
 class _LineProcess:
     """
     Minimal line-oriented subprocess wrapper (stdin/stdout).
@@ -98,7 +109,10 @@ class _LineProcess:
     def _readline(self, timeout=10.0):
         q = queue.Queue()
         def reader():
-            q.put(self.p.stdout.readline())
+            try:
+                q.put(self.p.stdout.readline())
+            except (OSError, ValueError):
+                q.put("")
         t = threading.Thread(target=reader, daemon=True)
         t.start()
         try:
@@ -106,7 +120,7 @@ class _LineProcess:
         except queue.Empty:
             raise TimeoutError(f"No response from {os.path.basename(self.exe_path)}")
         if not line:
-            raise RuntimeError(f"{os.path.basename(self.exe_path)} closed")
+            raise HelperDied(f"{os.path.basename(self.exe_path)} closed")
         return line.rstrip("\r\n")
 
     def send(self, line, timeout=10.0):
@@ -117,6 +131,13 @@ class _LineProcess:
             raise RuntimeError(resp)
         return resp
 
+    def kill(self):
+        try:
+            self.p.kill()
+            self.p.wait(timeout=5.0)
+        except Exception:
+            pass
+
     def close(self):
         try:
             self.send("exit")
@@ -127,13 +148,113 @@ class _LineProcess:
         except Exception:
             pass
 
+# Errors that mean the helper itself is gone or wedged (as opposed to an
+# "ERR ..." reply, which is the device telling us something and is not retried).
+_HELPER_FAULTS = (HelperDied, TimeoutError, OSError)
+
+class _SupervisedProcess:
+    """
+    _LineProcess that restarts its helper when it dies or hangs.
+
+    Configuration commands sent with replay=<key> (init/open) are remembered
+    and re-sent to every fresh process before the failed command is retried,
+    so a restart is invisible to the caller apart from the delay. A background
+    heartbeat pings idle helpers so a crash between scans is repaired before
+    the next command needs it.
+    """
+    def __init__(self, exe_path, heartbeat=None, heartbeat_s=5.0,
+                 max_restarts=3, restart_delay_s=1.0):
+        self.exe_path = exe_path
+        self.name = os.path.basename(exe_path)
+        self.heartbeat = heartbeat
+        self.heartbeat_s = heartbeat_s
+        self.max_restarts = max_restarts
+        self.restart_delay_s = restart_delay_s
+        self.replay = {}            # key -> (line, timeout), in first-sent order
+        self.restarts = 0
+        self.on_restart = None      # callback(name, restarts)
+        self.lock = threading.RLock()
+        self._closed = threading.Event()
+        self.proc = _LineProcess(exe_path)
+        if heartbeat:
+            threading.Thread(target=self._heartbeat_loop, daemon=True).start()
+
+    def transact(self, fn):
+        """
+        Run fn(proc) against a live helper, restarting and retrying on faults.
+        fn must be idempotent: it may run again from the start on a new process.
+        """
+        with self.lock:
+            last = None
+            for attempt in range(self.max_restarts + 1):
+                if self._closed.is_set():
+                    raise HelperDied(f"{self.name} closed")
+                try:
+                    if self.proc is None:
+                        self._respawn()
+                    return fn(self.proc)
+                except _HELPER_FAULTS as e:
+                    last = e
+                    if self.proc is not None:
+                        self.proc.kill()
+                        self.proc = None
+                    time.sleep(self.restart_delay_s)
+            raise HelperDied(f"{self.name} failed after {self.max_restarts} restarts: {last}")
+
+    def send(self, line, timeout=10.0, replay=None):
+        resp = self.transact(lambda p: p.send(line, timeout=timeout))
+        if replay:
+            self.replay[replay] = (line, timeout)
+        return resp
+
+    def _respawn(self):
+        proc = _LineProcess(self.exe_path)
+        try:
+            for line, timeout in self.replay.values():
+                proc.send(line, timeout=timeout)
+        except Exception:
+            proc.kill()
+            raise
+        self.proc = proc
+        self.restarts += 1
+        print(f"{self.name} restarted ({self.restarts})")
+        if self.on_restart:
+            try:
+                self.on_restart(self.name, self.restarts)
+            except Exception:
+                pass
+
+    def _heartbeat_loop(self):
+        while not self._closed.wait(self.heartbeat_s):
+            # Only ping while no command is in flight. The lock is free between
+            # scan commands (goto, settle sleeps), so pings can interleave with a scan.
+            if not self.lock.acquire(blocking=False):
+                continue
+            try:
+                self.transact(lambda p: p.send(self.heartbeat))
+            except Exception as e:
+                print(f"{self.name} heartbeat failed: {e}")
+            finally:
+                self.lock.release()
+
+    def close(self):
+        self._closed.set()
+        with self.lock:
+            if self.proc is not None:
+                self.proc.close()
+                self.proc = None
+
 class TH260Client:
     """Wrapper for th260_helper.exe"""
     def __init__(self, exe):
-        self.proc = _LineProcess(exe)
+        self.proc = _SupervisedProcess(exe, heartbeat="info")
+        self.settings = {}
 
     def init(self, binning=1, offset_ps=0, sync_div=1, sync_offset_ps=25000):
-        self.proc.send(f"init {binning} {offset_ps} {sync_div} {sync_offset_ps}", timeout=20.0)
+        self.settings = dict(binning=binning, offset_ps=offset_ps,
+                             sync_div=sync_div, sync_offset_ps=sync_offset_ps)
+        self.proc.send(f"init {binning} {offset_ps} {sync_div} {sync_offset_ps}",
+                       timeout=20.0, replay="init")
 
     def info(self):
         r = self.proc.send("info")
@@ -141,12 +262,15 @@ class TH260Client:
         return float(parts["RES"]), int(parts["CH"]), int(parts["LEN"])
 
     def acquire(self, tacq_ms=1000):
-        r = self.proc.send(f"acquire {tacq_ms}", timeout=max(10.0, tacq_ms/1000.0 + 5.0))
+        def transaction(p):
+            r = p.send(f"acquire {tacq_ms}", timeout=max(10.0, tacq_ms/1000.0 + 5.0))
+            # Next line is base64 payload
+            return r, p._readline(timeout=20.0)
+        # Header and payload are retried together so a restart never splits them
+        r, b64 = self.proc.transact(transaction)
         # r looks like: "OK HIST CH=<n> LEN=<bins> BYTES=<N>"
         meta = dict(kv.split("=") for kv in r[3:].split()[1:])
         ch, ln, nbytes = int(meta["CH"]), int(meta["LEN"]), int(meta["BYTES"])
-        # Next line is base64 payload
-        b64 = self.proc._readline(timeout=20.0)
         raw = base64.b64decode(b64.encode("ascii"))
         arr = np.frombuffer(raw, dtype=np.uint32)
         if arr.size != ch * ln:
@@ -159,14 +283,16 @@ class TH260Client:
 class StageClient:
     """Wrapper for stage_helper.exe (dynamic-loaded Kinesis, serials hardcoded in the EXE)"""
     def __init__(self, exe):
-        self.proc = _LineProcess(exe)
+        self.proc = _SupervisedProcess(exe, heartbeat="status")
+        self.trajectory = None
+        self.cursor = 0
 
     def open(self, serial_x=None, serial_y=None, vmax_tenths=750):
         # If no serials given, the helper uses its hardcoded defaults
         if serial_x and serial_y:
-            self.proc.send(f"open {serial_x} {serial_y} {vmax_tenths}")
+            self.proc.send(f"open {serial_x} {serial_y} {vmax_tenths}", replay="open")
         else:
-            self.proc.send(f"open {vmax_tenths}")
+            self.proc.send(f"open {vmax_tenths}", replay="open")
 
     def move_ix(self, ix, iy, width, height):
         self.proc.send(f"move_ix {ix} {iy} {width} {height}")
@@ -174,6 +300,27 @@ class StageClient:
     def setdac(self, vx_code, vy_code):
         self.proc.send(f"setdac {vx_code} {vy_code}")
 
+    def load_trajectory(self, trajectory):
+        """
+        Use a precomputed stage_trajectory.Trajectory; next() then steps through
+        its DAC codes. The helper has no upload or next command, so every point
+        is still one setdac round trip plus the stage settle: this is no faster
+        than move_ix. It allows serpentine and arbitrary point orders.
+        """
+        self.trajectory = trajectory
+        self.cursor = 0
+
+    def next(self):
+        """Move to the next trajectory point and return its (iy, ix)."""
+        if self.trajectory is None or self.cursor >= len(self.trajectory):
+            raise IndexError("Stage trajectory exhausted")
+        vx, vy = self.trajectory.codes[self.cursor]
+        self.setdac(int(vx), int(vy))
+        iy, ix = self.trajectory.pixels[self.cursor]
+        # Only advance once the move succeeded so a retry repeats the same point
+        self.cursor += 1
+        return int(iy), int(ix)
+
     def status(self):
         r = self.proc.send("status")
         # r: "OK X=<0|1> Y=<0|1>"
@@ -381,6 +528,8 @@ class FlimFrame(ttk.Frame):
         self.stage = None
         self.th = None
         self.scan_stop = threading.Event()
+        self.catalog = None
+        self.worker = None          # running scan or calibration thread
         self.build_ui()
 
     def build_ui(self):
@@ -398,6 +547,8 @@ class FlimFrame(ttk.Frame):
         self.width_e = ttk.Entry(cfg); self.width_e.grid(row=1, column=1, padx=5, pady=2); self.width_e.insert(0, "5")
         ttk.Label(cfg, text="Height (px):").grid(row=2, column=0, sticky="e")
         self.height_e = ttk.Entry(cfg); self.height_e.grid(row=2, column=1, padx=5, pady=2); self.height_e.insert(0, "5")
+        self.serpentine = tk.BooleanVar(value=False)
+        ttk.Checkbutton(cfg, text="Serpentine raster", variable=self.serpentine).grid(row=2, column=2, padx=5, sticky="w")
 
         ttk.Label(cfg, text="Wavelengths (nm, comma):").grid(row=3, column=0, sticky="e")
         self.wls_e = ttk.Entry(cfg, width=50); self.wls_e.grid(row=3, column=1, padx=5, pady=2)
@@ -425,6 +576,14 @@ class FlimFrame(ttk.Frame):
         ttk.Button(btns, text="Stop", command=self.stop_scan).grid(row=0, column=3, padx=5)
         ttk.Button(btns, text="Stage Status", command=self.show_status).grid(row=0, column=4, padx=5)
 
+        # Calibration: background (shutter closed) and IRF (scatterer) references
+        cal = ttk.Frame(cfg)
+        cal.grid(row=9, column=0, columnspan=3, pady=5)
+        self.apply_cal = tk.BooleanVar(value=False)
+        ttk.Checkbutton(cal, text="Apply calibration", variable=self.apply_cal).grid(row=0, column=0, padx=5)
+        ttk.Button(cal, text="Acquire Background", command=lambda: self.start_calibration("background")).grid(row=0, column=1, padx=5)
+        ttk.Button(cal, text="Acquire IRF", command=lambda: self.start_calibration("irf")).grid(row=0, column=2, padx=5)
+
         # Status
         self.status = ttk.Label(self, text="Status: idle")
         self.status.grid(row=1, column=0, padx=10, sticky="w")
@@ -443,11 +602,13 @@ class FlimFrame(ttk.Frame):
         try:
             if self.th is None:
                 self.th = TH260Client(TH260_HELPER_PATH)
+                self.th.proc.on_restart = self._helper_restarted
                 self.th.init(binning=1, offset_ps=0, sync_div=1, sync_offset_ps=25000)
                 res_ps, ch, hlen = self.th.info()
                 self.status.config(text=f"TH260 ready: {ch} ch, {hlen} bins, {res_ps:.1f} ps/bin")
             if self.stage is None:
                 self.stage = StageClient(STAGE_HELPER_PATH)
+                self.stage.proc.on_restart = self._helper_restarted
                 vmax = int(self.vmax_e.get() or "750")
                 self.stage.open(vmax_tenths=vmax)  # uses hardcoded serials in helper
                 self.status.config(text=self.status.cget("text") + " | Stage ready")
@@ -471,20 +632,59 @@ class FlimFrame(ttk.Frame):
             self.th = None
         self.status.config(text="Status: disconnected")
 
+    def _busy(self):
+        # Scans and calibrations both drive the shutter, mono and TH260
+        if self.worker is not None and self.worker.is_alive():
+            messagebox.showerror("Busy", "A scan or calibration is already running.")
+            return True
+        return False
+
     def start_scan(self):
         if self.th is None or self.stage is None:
             messagebox.showerror("Not connected", "Connect helpers first.")
             return
+        if self._busy():
+            return
         outdir = self.out_e.get().strip()
         if not outdir:
             messagebox.showerror("Output", "Pick an output folder.")
             return
         os.makedirs(outdir, exist_ok=True)
         self.scan_stop.clear()
-        t = threading.Thread(target=self._scan_thread, args=(outdir,), daemon=True)
-        t.start()
+        self.worker = threading.Thread(target=self._scan_thread, args=(outdir,), daemon=True)
+        self.worker.start()
         self.status.config(text="Status: scanning...")
 
+    def start_calibration(self, which):
+        if self.th is None:
+            messagebox.showerror("Not connected", "Connect helpers first.")
+            return
+        if self._busy():
+            return
+        self.worker = threading.Thread(target=self._calibration_thread, args=(which,), daemon=True)
+        self.worker.start()
+        self.status.config(text=f"Status: acquiring {which}...")
+
+    def _calibration_thread(self, which):
+        try:
+            wls = [float(x) for x in self.wls_e.get().replace(";", ",").split(",") if x.strip()]
+            tacq_ms = int(self.tacq_e.get())
+            mono_settle = float(self.mono_settle_e.get())/1000.0
+            cache = calibration.CalibrationCache(CALIBRATION_DIR)
+            goto = lambda nm: run("goto", nm)
+            if which == "background":
+                run("close_shutter")
+                try:
+                    path = calibration.acquire_background(self.th, cache, wls, goto, tacq_ms=tacq_ms, settle_s=mono_settle)
+                finally:
+                    run("open_shutter")
+            else:
+                path = calibration.acquire_irf(self.th, cache, wls, goto, tacq_ms=tacq_ms, settle_s=mono_settle)
+            self._set_status(f"Saved {which}: {path}")
+        except Exception as e:
+            self._set_status(f"Error: {e}")
+            messagebox.showerror("Calibration error", str(e))
+
     def stop_scan(self):
         self.scan_stop.set()
         self.status.config(text="Status: stopping...")
@@ -497,6 +697,8 @@ class FlimFrame(ttk.Frame):
             messagebox.showerror("Stage Status", str(e))
 
     def _scan_thread(self, outdir):
+        scan_id, stats = None, scan_catalog.ScanStats()
+        worker_error = None
         try:
             width  = int(self.width_e.get())
             height = int(self.height_e.get())
@@ -508,43 +710,125 @@ class FlimFrame(ttk.Frame):
             # Query TH260 info once for metadata
             res_ps, ch, hlen = self.th.info()
 
-            for iy in range(height):
-                for ix in range(width):
-                    if self.scan_stop.is_set(): raise KeyboardInterrupt()
-
-                    # 1) move stage
-                    self.stage.move_ix(ix, iy, width, height)
-                    time.sleep(st_settle)
-
-                    for nm in wls:
-                        if self.scan_stop.is_set(): raise KeyboardInterrupt()
-
-                        # 2) move spectrograph
-                        run("goto", nm)
-                        time.sleep(mono_settle)  # or poll 'position' if you prefer
-
-                        # 3) TH260 acquire
-                        counts = self.th.acquire(tacq_ms=tacq_ms)  # shape (ch, hlen), uint32
-
-                        # 4) save one NPZ per (y,x,λ)
-                        fname = os.path.join(outdir, f"y{iy:03d}_x{ix:03d}_nm{nm:.1f}.npz")
-                        np.savez_compressed(
-                            fname,
-                            counts=counts,
-                            res_ps=res_ps,
-                            tacq_ms=tacq_ms,
-                            wavelength_nm=nm,
-                            pixel=(iy, ix),
-                        )
-                    # update status line
-                    self._set_status(f"Scanning... row {iy+1}/{height}, col {ix+1}/{width}")
-
+            # Background/IRF corrections are precomputed per wavelength up front
+            cal = None
+            if self.apply_cal.get():
+                cal = calibration.Calibration(calibration.CalibrationCache(CALIBRATION_DIR), self.th.settings)
+                if not cal.available:
+                    raise RuntimeError("No calibration recorded for the current TH260 settings.")
+                cal.prepare(wls, tacq_ms, (ch, hlen))
+
+            # Register the scan recipe before the first voxel is written
+            try:
+                if self.catalog is None:
+                    self.catalog = scan_catalog.ScanCatalog(CATALOG_PATH)
+                scan_id = self.catalog.begin_scan(
+                    outdir,
+                    recipe=dict(width=width, height=height, wavelengths_nm=wls, tacq_ms=tacq_ms,
+                                stage_settle_ms=st_settle*1000.0, mono_settle_ms=mono_settle*1000.0,
+                                vmax_tenths=int(self.vmax_e.get() or "750"),
+                                serpentine=self.serpentine.get(),
+                                calibrated=cal is not None),
+                    device=dict(res_ps=res_ps, channels=ch, hist_len=hlen, **self.th.settings),
+                )
+            except Exception as e:
+                print(f"Scan catalog unavailable: {e}")
+
+            # Channel reduction + NPZ compression run in workers while the next voxel acquires
+            pipeline = channels.ChannelPipeline((height, width, len(wls)), ch, res_ps)
+            try:
+                self._scan_voxels(outdir, pipeline, cal, stats, width, height, wls,
+                                  tacq_ms, st_settle, mono_settle, res_ps)
+            finally:
+                # Always flush and save the maps; a worker error must not mask the
+                # scan's own stop/error, so it is only raised if the scan succeeded.
+                worker_error = pipeline.close()
+                try:
+                    pipeline.save(outdir, wls)
+                except Exception as e:
+                    print(f"channels.npz not written: {e}")
+            if worker_error is not None:
+                raise worker_error
+
+            self._finish_catalog(scan_id, "done", stats)
+
+            # Precompute photon maps / time-gate cumsums / pyramids for browsing.
+            # The scan data is already complete, so a failure here is only a warning.
+            self._set_status("Building browse products...")
+            try:
+                flim_products.build_products(outdir)
+            except Exception as e:
+                print(f"Browse products not built: {e}")
+                self._set_status(f"Done (warning: browse products not built: {e}).")
+                return
             self._set_status("Done.")
         except KeyboardInterrupt:
-            self._set_status("Stopped.")
+            note = self._write_error_note(worker_error)
+            self._finish_catalog(scan_id, "stopped" + note, stats)
+            self._set_status("Stopped." + note)
         except Exception as e:
-            self._set_status(f"Error: {e}")
-            messagebox.showerror("FLIM scan error", str(e))
+            note = "" if e is worker_error else self._write_error_note(worker_error)
+            self._finish_catalog(scan_id, f"error: {e}{note}", stats)
+            self._set_status(f"Error: {e}{note}")
+            messagebox.showerror("FLIM scan error", str(e) + note)
+
+    def _write_error_note(self, worker_error):
+        # A failed voxel write is reported even when a stop/scan error is the one raised
+        if worker_error is None:
+            return ""
+        print(f"Voxel write failed: {worker_error}")
+        return f" (voxel write failed: {worker_error})"
+
+    def _scan_voxels(self, outdir, pipeline, cal, stats, width, height, wls,
+                     tacq_ms, st_settle, mono_settle, res_ps):
+        # DAC codes for the whole raster are computed once, then stepped with next()
+        traj = stage_trajectory.Trajectory.raster(width, height, serpentine=self.serpentine.get())
+        self.stage.load_trajectory(traj)
+        for n in range(len(traj)):
+            if self.scan_stop.is_set(): raise KeyboardInterrupt()
+
+            # 1) move stage
+            iy, ix = self.stage.next()
+            time.sleep(st_settle)
+
+            for k, nm in enumerate(wls):
+                if self.scan_stop.is_set(): raise KeyboardInterrupt()
+
+                # 2) move spectrograph
+                run("goto", nm)
+                time.sleep(mono_settle)  # or poll 'position' if you prefer
+
+                # 3) TH260 acquire
+                counts = self.th.acquire(tacq_ms=tacq_ms)  # shape (ch, hlen), uint32
+                stats.add(nm, counts)
+
+                # 4) queue one NPZ per (y,x,λ); channel stats are added by the worker
+                extra = {} if cal is None else {"counts_corr": cal.correct(counts, nm)}
+                fname = os.path.join(outdir, f"y{iy:03d}_x{ix:03d}_nm{nm:.1f}.npz")
+                pipeline.submit(
+                    (iy, ix, k),
+                    fname,
+                    counts,
+                    **extra,
+                    res_ps=res_ps,
+                    tacq_ms=tacq_ms,
+                    wavelength_nm=nm,
+                    pixel=(iy, ix),
+                )
+            # update status line
+            self._set_status(f"Scanning... pixel {n+1}/{len(traj)} (row {iy+1}/{height}, col {ix+1}/{width})")
+
+    def _finish_catalog(self, scan_id, status, stats):
+        if scan_id is None:
+            return
+        try:
+            self.catalog.finish_scan(scan_id, status, stats)
+        except Exception as e:
+            print(f"Scan catalog update failed: {e}")
+
+    def _helper_restarted(self, name, restarts):
+        # Called from the scan or heartbeat thread after init/open was replayed
+        self._set_status(f"{name} restarted ({restarts}x), continuing...")
 
     def _set_status(self, s):
         # marshal to UI thread
@@ -0,0 +1,238 @@
+# scan_catalog.py
+"""
+Local SQLite catalog of FLIM scans.
+
+One row per scan holds the full recipe (grid, wavelengths, timings), TH260 and
+stage settings, where the files live and summary statistics; per-wavelength
+rows make "which scans covered 520 nm" an index lookup. The recipe is also
+written next to the data as recipe.json so a folder can be re-indexed later.
+
+Usage:
+    python scan_catalog.py index <scan folder> [...]
+    python scan_catalog.py find [nm=520] [tacq_min=500] [since=2026-09-01]
+"""
+import os
+import sys
+import json
+import time
+import sqlite3
+from contextlib import closing
+from datetime import datetime
+
+import numpy as np
+
+CATALOG_PATH = os.path.join(os.path.expanduser("~"), "SpectralFLIM", "catalog.sqlite")
+RECIPE_FILE = "recipe.json"
+VOXEL_PATTERN = "y{iy:03d}_x{ix:03d}_nm{nm:.1f}.npz"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS scans (
+    id              INTEGER PRIMARY KEY,
+    outdir          TEXT UNIQUE NOT NULL,
+    file_pattern    TEXT,
+    started         REAL,
+    finished        REAL,
+    status          TEXT,
+    width           INTEGER,
+    height          INTEGER,
+    n_wavelengths   INTEGER,
+    wl_min_nm       REAL,
+    wl_max_nm       REAL,
+    tacq_ms         INTEGER,
+    stage_settle_ms REAL,
+    mono_settle_ms  REAL,
+    vmax_tenths     INTEGER,
+    res_ps          REAL,
+    channels        INTEGER,
+    hist_len        INTEGER,
+    binning         INTEGER,
+    offset_ps       INTEGER,
+    sync_div        INTEGER,
+    sync_offset_ps  INTEGER,
+    n_voxels        INTEGER,
+    total_counts    INTEGER,
+    max_voxel_counts INTEGER,
+    recipe_json     TEXT
+);
+CREATE TABLE IF NOT EXISTS scan_wavelengths (
+    scan_id      INTEGER NOT NULL REFERENCES scans(id) ON DELETE CASCADE,
+    nm           REAL NOT NULL,
+    total_counts INTEGER,
+    PRIMARY KEY (scan_id, nm)
+);
+CREATE INDEX IF NOT EXISTS ix_scans_started ON scans(started);
+CREATE INDEX IF NOT EXISTS ix_scans_tacq ON scans(tacq_ms, started);
+CREATE INDEX IF NOT EXISTS ix_wavelengths_nm ON scan_wavelengths(nm, scan_id);
+"""
+
+# recipe/device keys stored in their own columns
+_RECIPE_COLUMNS = ("width", "height", "tacq_ms", "stage_settle_ms", "mono_settle_ms", "vmax_tenths")
+_DEVICE_COLUMNS = ("res_ps", "channels", "hist_len", "binning", "offset_ps", "sync_div", "sync_offset_ps")
+
+
+class ScanStats:
+    """Running per-scan statistics, fed one histogram at a time by the scan loop."""
+    def __init__(self):
+        self.n_voxels = 0
+        self.total_counts = 0
+        self.max_voxel_counts = 0
+        self.per_wavelength = {}
+
+    def add(self, nm, counts):
+        n = int(counts.sum())
+        self.n_voxels += 1
+        self.total_counts += n
+        self.max_voxel_counts = max(self.max_voxel_counts, n)
+        self.per_wavelength[nm] = self.per_wavelength.get(nm, 0) + n
+
+
+class ScanCatalog:
+    def __init__(self, path=CATALOG_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with closing(self._connect()) as db, db:
+            db.executescript(_SCHEMA)
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30.0)
+        db.row_factory = sqlite3.Row
+        db.execute("PRAGMA foreign_keys = ON")
+        return db
+
+    def begin_scan(self, outdir, recipe, device, started=None):
+        """
+        Register a scan before acquisition starts. recipe holds the FlimFrame
+        entries (width, height, wavelengths_nm, tacq_ms, ...); device holds
+        TH260/stage settings. Returns the scan id.
+        """
+        outdir = os.path.abspath(outdir)
+        started = time.time() if started is None else started
+        wls = sorted(float(nm) for nm in recipe.get("wavelengths_nm", []))
+        with open(os.path.join(outdir, RECIPE_FILE), "w", encoding="utf-8") as f:
+            json.dump({"started": started, "recipe": recipe, "device": device}, f, indent=2)
+
+        cols = {
+            "outdir": outdir,
+            "file_pattern": VOXEL_PATTERN,
+            "started": started,
+            "status": "running",
+            "n_wavelengths": len(wls),
+            "wl_min_nm": wls[0] if wls else None,
+            "wl_max_nm": wls[-1] if wls else None,
+            "recipe_json": json.dumps({"recipe": recipe, "device": device}),
+        }
+        cols.update({k: recipe.get(k) for k in _RECIPE_COLUMNS})
+        cols.update({k: device.get(k) for k in _DEVICE_COLUMNS})
+        with closing(self._connect()) as db, db:
+            # Re-running into the same folder replaces the old entry
+            db.execute("DELETE FROM scans WHERE outdir = ?", (outdir,))
+            cur = db.execute(
+                f"INSERT INTO scans ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))})",
+                list(cols.values()))
+            scan_id = cur.lastrowid
+            db.executemany("INSERT INTO scan_wavelengths (scan_id, nm) VALUES (?, ?)",
+                           [(scan_id, nm) for nm in wls])
+        return scan_id
+
+    def finish_scan(self, scan_id, status, stats, finished=None):
+        """Record the outcome ("done", "stopped", "error: ...") and ScanStats of a scan."""
+        finished = time.time() if finished is None else finished
+        with closing(self._connect()) as db, db:
+            db.execute(
+                "UPDATE scans SET finished = ?, status = ?, n_voxels = ?, total_counts = ?, "
+                "max_voxel_counts = ? WHERE id = ?",
+                (finished, status, stats.n_voxels, stats.total_counts,
+                 stats.max_voxel_counts, scan_id))
+            db.executemany(
+                "INSERT INTO scan_wavelengths (scan_id, nm, total_counts) VALUES (?, ?, ?) "
+                "ON CONFLICT(scan_id, nm) DO UPDATE SET total_counts = excluded.total_counts",
+                [(scan_id, float(nm), n) for nm, n in stats.per_wavelength.items()])
+
+    def index_folder(self, outdir):
+        """Add an existing scan folder (e.g. from before the catalog) by reading it once."""
+        from flim_cube import ScanIndex
+        idx = ScanIndex(outdir)
+        saved = {}
+        rpath = os.path.join(outdir, RECIPE_FILE)
+        if os.path.exists(rpath):
+            with open(rpath, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+        recipe = dict(saved.get("recipe", {}))
+        recipe.setdefault("width", idx.width)
+        recipe.setdefault("height", idx.height)
+        recipe.setdefault("wavelengths_nm", idx.wavelengths.tolist())
+        recipe.setdefault("tacq_ms", idx.tacq_ms)
+        device = dict(saved.get("device", {}))
+        device.setdefault("res_ps", idx.res_ps)
+        device.setdefault("channels", idx.channels)
+        device.setdefault("hist_len", idx.hist_len)
+
+        mtimes = [os.path.getmtime(p) for p in idx.paths.values()]
+        stats = ScanStats()
+        for (iy, ix, nm), p in idx.paths.items():
+            with np.load(p) as z:
+                stats.add(nm, z["counts"])
+        scan_id = self.begin_scan(outdir, recipe, device, started=saved.get("started", min(mtimes)))
+        self.finish_scan(scan_id, "indexed", stats, finished=max(mtimes))
+        return scan_id
+
+    def find(self, nm=None, tacq_min=None, tacq_max=None, since=None, until=None,
+             status=None, tol_nm=0.05):
+        """
+        Scans matching all given filters, newest first. since/until take unix
+        times, datetimes or ISO date strings.
+        """
+        where, args = [], []
+        if nm is not None:
+            where.append("id IN (SELECT scan_id FROM scan_wavelengths WHERE nm BETWEEN ? AND ?)")
+            args += [nm - tol_nm, nm + tol_nm]
+        if tacq_min is not None:
+            where.append("tacq_ms >= ?"); args.append(tacq_min)
+        if tacq_max is not None:
+            where.append("tacq_ms <= ?"); args.append(tacq_max)
+        if since is not None:
+            where.append("started >= ?"); args.append(_timestamp(since))
+        if until is not None:
+            where.append("started < ?"); args.append(_timestamp(until))
+        if status is not None:
+            where.append("status = ?"); args.append(status)
+        sql = "SELECT * FROM scans"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY started DESC"
+        with closing(self._connect()) as db:
+            return [dict(r) for r in db.execute(sql, args)]
+
+    def wavelengths(self, scan_id):
+        """[(nm, total_counts), ...] for one scan."""
+        with closing(self._connect()) as db:
+            return [tuple(r) for r in db.execute(
+                "SELECT nm, total_counts FROM scan_wavelengths WHERE scan_id = ? ORDER BY nm",
+                (scan_id,))]
+
+
+def _timestamp(t):
+    if isinstance(t, (int, float)):
+        return float(t)
+    if isinstance(t, str):
+        t = datetime.fromisoformat(t)
+    return t.timestamp()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in ("index", "find"):
+        print(__doc__, file=sys.stderr)
+        sys.exit(1)
+    cat = ScanCatalog()
+    if sys.argv[1] == "index":
+        for d in sys.argv[2:]:
+            print(f"{d}: scan id {cat.index_folder(d)}")
+    else:
+        filters = dict(a.split("=", 1) for a in sys.argv[2:])
+        for k in ("nm", "tacq_min", "tacq_max"):
+            if k in filters:
+                filters[k] = float(filters[k])
+        for row in cat.find(**filters):
+            when = datetime.fromtimestamp(row["started"]).isoformat(timespec="minutes")
+            print(f"{row['id']:5d}  {when}  {row['status']:<8}  tacq={row['tacq_ms']}ms  "
+                  f"{row['wl_min_nm']}-{row['wl_max_nm']} nm  {row['outdir']}")
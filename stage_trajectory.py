@@ -0,0 +1,52 @@
+# stage_trajectory.py
+"""
+Precomputed stage trajectories for StageClient.
+
+The DAC codes for a whole raster (or any list of pixel positions) are
+computed once here. They reproduce stage_helper's move_ix exactly:
+code = ix * 0x7fff // (width - 1), truncating integer division, so a scan
+stepped through setdac lands on the same codes as one driven by move_ix.
+"""
+import numpy as np
+
+DAC_MAX = 32767
+
+
+def pixel_to_dac(ix, iy, width, height, dac_max=DAC_MAX):
+    """Vectorized (ix, iy) -> (vx_code, vy_code) for a width x height grid."""
+    ix = np.asarray(ix, dtype=np.int64)
+    iy = np.asarray(iy, dtype=np.int64)
+    vx = (ix * dac_max // max(width - 1, 1)).astype(np.int32)
+    vy = (iy * dac_max // max(height - 1, 1)).astype(np.int32)
+    return vx, vy
+
+
+class Trajectory:
+    """
+    Ordered stage positions: pixels (N, 2) as (iy, ix) and codes (N, 2) as
+    (vx, vy) DAC codes ready to send.
+    """
+    def __init__(self, pixels, width, height, dac_max=DAC_MAX):
+        self.pixels = np.asarray(pixels, dtype=np.int32).reshape(-1, 2)
+        if len(self.pixels) and (self.pixels.min() < 0 or (self.pixels[:, 0] >= height).any()
+                                 or (self.pixels[:, 1] >= width).any()):
+            raise ValueError("Trajectory point outside the scan grid")
+        self.width, self.height = width, height
+        vx, vy = pixel_to_dac(self.pixels[:, 1], self.pixels[:, 0], width, height, dac_max)
+        self.codes = np.stack([vx, vy], axis=1)
+
+    def __len__(self):
+        return len(self.pixels)
+
+    @classmethod
+    def raster(cls, width, height, serpentine=False, dac_max=DAC_MAX):
+        """Row-by-row raster; serpentine reverses every other row to avoid flyback."""
+        iy, ix = np.mgrid[0:height, 0:width]
+        if serpentine:
+            ix[1::2] = ix[1::2, ::-1]
+        return cls(np.stack([iy.ravel(), ix.ravel()], axis=1), width, height, dac_max)
+
+    @classmethod
+    def from_points(cls, points, width, height, dac_max=DAC_MAX):
+        """Arbitrary (iy, ix) visiting order, e.g. a region of interest."""
+        return cls(points, width, height, dac_max)